@@ -8,15 +8,30 @@ Script to fetch transaction emails from Gmail, parse them, and store results in
 # - For Google Sheets via gspread, run `python -m gspread auth` to generate `~/.config/gspread/credentials.json` and authorized tokens.
 
 import os
+import asyncio
+import functools
+import sqlite3
+import random
+import threading
 import datetime
 import base64
 import logging
-from bs4 import BeautifulSoup
-from email import message_from_bytes
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from bs4 import BeautifulSoup, SoupStrainer
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+from email import message_from_bytes, policy
 from email.header import decode_header
+from email.parser import BytesHeaderParser
+from email.utils import getaddresses
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2
 import gspread
 
 from google.auth.transport.requests import Request
@@ -38,9 +53,32 @@ SCOPES = [
 SPREADSHEET_ID = '1nLp1mqmX0IciJ-cS8noPyD_NcL89CZZDjfsAXhH5A_M'
 SHEET_NAME = 'AxisBank'
 
+# Calls per batch HTTP request. Gmail allows 100, but messages.get costs 5 of the 250 quota
+# units/s per user, and Google recommends batches of at most 50
+BATCH_SIZE = 50
+# Retries (with backoff) for messages whose fetch failed with a transient error such as a 429
+FETCH_RETRIES = 3
+# Number of concurrent requests per round when falling back from batch requests
+# (25 gets = 125 quota units, well below Gmail's 250 units/s per user)
+ASYNC_CHUNK_SIZE = 25
+# Worker processes parsing emails while the next batch is being fetched (None = one per CPU core)
+PARSE_WORKERS = None
+# Emails sent to a worker process per task, to amortise pickling overhead
+PARSE_CHUNK_SIZE = 8
+
+# Local cache of processed Gmail message IDs and the last synced mailbox historyId
+CACHE_DB = 'cache.db'
+# Seen IDs older than this are pruned. Neither the month search nor Gmail's history (kept
+# for about a week) can list a message again after that long, so the IDs are no longer needed
+SEEN_RETENTION_DAYS = 62
+ALERT_SENDER = 'alerts@axisbank.com'
+
+# Only build the DOM for tags that carry visible transaction text (skips <head>, images, etc.)
+ONLY_BODY = SoupStrainer(['body', 'p', 'td', 'div', 'span', 'table', 'tr'])
+
 
 def authenticate_gmail():
-    """Authenticate and return Gmail API service."""
+    """Authenticate and return the Gmail API service and its credentials."""
     try:
         logging.info("Authenticating with Gmail API...")
         creds = None
@@ -60,7 +98,7 @@ def authenticate_gmail():
             if not creds:
                 if not os.path.exists('credentials.json'):
                     logging.error("Missing 'credentials.json' (OAuth client secrets). Place it in the project directory.")
-                    return None
+                    return None, None
                 flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
                 creds = flow.run_local_server(port=0)
 
@@ -70,7 +108,7 @@ def authenticate_gmail():
 
         service = build('gmail', 'v1', credentials=creds)
         logging.info("Gmail API authentication successful.")
-        return service
+        return service, creds
     except Exception as e:
         # Detect common OAuth errors (expired / revoked tokens) and try a one-time re-auth
         msg = str(e)
@@ -89,94 +127,361 @@ def authenticate_gmail():
             try:
                 if not os.path.exists('credentials.json'):
                     logging.error("Missing 'credentials.json' (OAuth client secrets). Place it in the project directory and re-run.")
-                    return None
+                    return None, None
                 flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
                 creds = flow.run_local_server(port=0)
                 with open('token.json', 'w') as token:
                     token.write(creds.to_json())
                 service = build('gmail', 'v1', credentials=creds)
                 logging.info("Gmail API authentication successful after re-auth.")
-                return service
+                return service, creds
             except Exception as reauth_err:
                 logging.error(f"Re-authentication failed: {reauth_err}")
                 logging.error("If this persists, check: (1) system clock/timezone, (2) that the OAuth consent wasn't revoked in your Google account, or (3) delete any other stored tokens.")
-                return None
+                return None, None
+
+        return None, None
+
+
+def _is_gone(exc):
+    """Return True if exc is a 404, i.e. the message was deleted (e.g. an autosaved draft)."""
+    return isinstance(exc, HttpError) and getattr(exc.resp, 'status', None) == 404
+
+
+def _is_transaction_alert(sender, subject):
+    """Return True if the From/Subject headers belong to an INR alert from the bank."""
+    # Compare the parsed address exactly, so display names or look-alike domains can't pass
+    addresses = getaddresses([sender])
+    return (
+        len(addresses) == 1
+        and addresses[0][1].casefold() == ALERT_SENDER
+        and 'INR' in subject
+    )
+
 
+def _decode_raw_message(response):
+    """Decode a `format='raw'` Gmail response into an `EmailMessage`, or None if it isn't an INR alert."""
+    msg_bytes = base64.urlsafe_b64decode(response['raw'].encode('ASCII'))
+    # Headers alone are cheap to parse; only build the full message for transaction alerts
+    headers = BytesHeaderParser(policy=policy.default).parsebytes(msg_bytes)
+    if not _is_transaction_alert(str(headers['from'] or ''), headers['subject'] or ''):
         return None
+    return message_from_bytes(msg_bytes, policy=policy.default)
 
 
-def fetch_transaction_emails(service):
-    """Fetch emails from alerts@axisbank.com for the current month only."""
+def _decode_subject(raw_subject):
+    """Decode a possibly MIME-encoded Subject header."""
     try:
-        logging.info("Fetching transaction emails for current month from alerts@axisbank.com...")
-        today = datetime.date.today()
-        first_day = today.replace(day=1)
-        if today.month == 12:
-            next_month = today.replace(year=today.year+1, month=1, day=1)
-        else:
-            next_month = today.replace(month=today.month+1, day=1)
-        after = first_day.strftime('%Y/%m/%d')
-        before = next_month.strftime('%Y/%m/%d')
-        query = f"from:alerts@axisbank.com after:{after} before:{before}"
-        logging.debug(f"Gmail search query: {query}")
-        results = service.users().messages().list(userId='me', q=query).execute()
-        messages = results.get('messages', [])
+        dh = decode_header(raw_subject)
+        return ''.join([
+            (part.decode(enc or 'utf-8') if isinstance(part, bytes) else part)
+            for part, enc in dh
+        ])
+    except Exception as e:
+        logging.warning(f"Failed to decode subject: {e}")
+        return raw_subject
+
+
+def _filter_by_subject(service, chunk):
+    """Return the alert messages in chunk whose Subject mentions INR, using one metadata-only batch request."""
+    kept = []
+
+    def on_metadata(request_id, response, exception):
+        if _is_gone(exception):
+            logging.debug(f"Message {request_id} no longer exists; skipping it.")
+            return
+        if exception is not None:
+            # Keep it and let the full fetch decide
+            logging.warning(f"Failed to fetch metadata for message {request_id}: {exception}")
+            kept.append({'id': request_id})
+            return
+        headers = {h['name'].lower(): h['value'] for h in response.get('payload', {}).get('headers', [])}
+        if _is_transaction_alert(headers.get('from', ''), _decode_subject(headers.get('subject', ''))):
+            kept.append({'id': request_id})
+
+    batch = service.new_batch_http_request(callback=on_metadata)
+    for msg in chunk:
+        batch.add(
+            service.users().messages().get(
+                userId='me', id=msg['id'], format='metadata', metadataHeaders=['Subject', 'Date', 'From']
+            ),
+            request_id=msg['id']
+        )
+    batch.execute()
+    return kept
+
+
+def _fetch_batch(service, chunk):
+    """Fetch a chunk of messages in a single batch HTTP request.
+
+    Returns the (message id, email) pairs fetched and the IDs of messages that failed
+    with a transient error. Deleted messages (404) are skipped, not counted as failed.
+    """
+    fetched = []
+    failed = []
+
+    def on_message(request_id, response, exception):
+        if _is_gone(exception):
+            logging.debug(f"Message {request_id} no longer exists; skipping it.")
+            return
+        if exception is not None:
+            logging.warning(f"Failed to fetch message {request_id}: {exception}")
+            failed.append(request_id)
+            return
+        mime_msg = _decode_raw_message(response)
+        if mime_msg is not None:
+            fetched.append((request_id, mime_msg))
+
+    batch = service.new_batch_http_request(callback=on_message)
+    for msg in chunk:
+        batch.add(service.users().messages().get(userId='me', id=msg['id'], format='raw'), request_id=msg['id'])
+    batch.execute()
+    return fetched, failed
+
+
+async def _fetch_concurrently(service, credentials, chunk):
+    """Fetch a chunk of messages with concurrent single requests (used when the batch endpoint fails).
+
+    Returns the (message id, email) pairs fetched and the IDs of messages that failed
+    with a transient error. Deleted messages (404) are skipped, not counted as failed.
+    """
+    local = threading.local()
+
+    def get_message(msg_id):
+        # httplib2 is not thread-safe, so every worker thread gets its own connection and reuses it
+        if not hasattr(local, 'http'):
+            local.http = AuthorizedHttp(credentials, http=httplib2.Http())
+        return service.users().messages().get(userId='me', id=msg_id, format='raw').execute(http=local.http)
+
+    fetched = []
+    failed = []
+    loop = asyncio.get_running_loop()
+    # A dedicated pool, since the default executor has fewer than ASYNC_CHUNK_SIZE threads
+    with ThreadPoolExecutor(max_workers=ASYNC_CHUNK_SIZE) as executor:
+        for i in range(0, len(chunk), ASYNC_CHUNK_SIZE):
+            sub_chunk = chunk[i:i+ASYNC_CHUNK_SIZE]
+            responses = await asyncio.gather(
+                *(loop.run_in_executor(executor, get_message, msg['id']) for msg in sub_chunk),
+                return_exceptions=True
+            )
+            for msg, response in zip(sub_chunk, responses):
+                if _is_gone(response):
+                    logging.debug(f"Message {msg['id']} no longer exists; skipping it.")
+                    continue
+                if isinstance(response, Exception):
+                    logging.warning(f"Failed to fetch message {msg['id']}: {response}")
+                    failed.append(msg['id'])
+                    continue
+                mime_msg = _decode_raw_message(response)
+                if mime_msg is not None:
+                    fetched.append((msg['id'], mime_msg))
+    return fetched, failed
+
+
+def _fetch_chunk(service, credentials, chunk):
+    """Fetch one chunk of raw messages, falling back to concurrent requests if the batch fails."""
+    try:
+        return _fetch_batch(service, chunk)
+    except HttpError as batch_err:
+        logging.warning(f"Batch request failed, falling back to concurrent requests: {batch_err}")
+        return asyncio.run(_fetch_concurrently(service, credentials, chunk))
+
+
+def _fetch_chunk_with_retry(service, credentials, chunk):
+    """Fetch one chunk of raw messages, retrying transiently failed messages with backoff.
+
+    Returns the (message id, email) pairs fetched and the IDs still failing after all retries.
+    """
+    fetched, failed = _fetch_chunk(service, credentials, chunk)
+    attempt = 0
+    while failed and attempt < FETCH_RETRIES:
+        attempt += 1
+        delay = 2 ** (attempt - 1) * (0.8 + 0.4 * random.random())
+        logging.warning(f'{len(failed)} messages failed (attempt {attempt}/{FETCH_RETRIES}). Retrying after {delay:.1f}s...')
+        time.sleep(delay)
+        retry_ids = set(failed)
+        more, failed = _fetch_chunk(service, credentials, [msg for msg in chunk if msg['id'] in retry_ids])
+        fetched.extend(more)
+    return fetched, failed
+
+
+def open_cache(path=CACHE_DB):
+    """Open (and create if needed) the local SQLite cache of processed messages."""
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS seen(msg_id TEXT PRIMARY KEY, ts INTEGER)")
+        conn.execute("CREATE TABLE IF NOT EXISTS sync_state(key TEXT PRIMARY KEY, value TEXT)")
+    return conn
+
+
+def _load_seen(cache):
+    """Return the set of message IDs processed by earlier runs."""
+    return {row[0] for row in cache.execute("SELECT msg_id FROM seen")}
+
+
+def _get_history_id(service):
+    """Return the mailbox's current historyId, to resume from on the next run."""
+    return service.users().getProfile(userId='me').execute()['historyId']
+
+
+def mark_processed(cache, msg_ids):
+    """Record processed message IDs, prune expired ones and commit the pending historyId in a single transaction."""
+    now = int(time.time())
+    with cache:
+        cache.executemany("INSERT OR IGNORE INTO seen(msg_id, ts) VALUES (?, ?)", [(msg_id, now) for msg_id in msg_ids])
+        cache.execute("DELETE FROM seen WHERE ts < ?", (now - SEEN_RETENTION_DAYS * 86400,))
+        cache.execute(
+            "INSERT OR REPLACE INTO sync_state(key, value) "
+            "SELECT 'history_id', value FROM sync_state WHERE key = 'pending_history_id'"
+        )
+        cache.execute("DELETE FROM sync_state WHERE key = 'pending_history_id'")
+
+
+def _list_new_since(service, start_history_id):
+    """Return messages added to the mailbox since start_history_id, via users.history.list."""
+    # Keyed by ID: a message can appear in several history records, and batch requests reject duplicate IDs
+    messages = {}
+    page_token = None
+    while True:
+        results = service.users().history().list(
+            userId='me', startHistoryId=start_history_id, historyTypes=['messageAdded'], pageToken=page_token
+        ).execute()
+        for record in results.get('history', []):
+            for added in record.get('messagesAdded', []):
+                msg_id = added['message']['id']
+                messages[msg_id] = {'id': msg_id}
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return list(messages.values())
+
+
+def _list_month(service):
+    """Return this month's messages from the alert sender, via a Gmail search."""
+    today = datetime.date.today()
+    first_day = today.replace(day=1)
+    if today.month == 12:
+        next_month = today.replace(year=today.year+1, month=1, day=1)
+    else:
+        next_month = today.replace(month=today.month+1, day=1)
+    after = first_day.strftime('%Y/%m/%d')
+    before = next_month.strftime('%Y/%m/%d')
+    query = f"from:{ALERT_SENDER} after:{after} before:{before} subject:INR"
+    logging.debug(f"Gmail search query: {query}")
+    results = service.users().messages().list(userId='me', q=query).execute()
+    return results.get('messages', [])
+
+
+def fetch_transaction_emails(service, credentials, cache=None):
+    """Fetch transaction alert emails from ALERT_SENDER.
+
+    Yields (Gmail message id, email) pairs. Without a cache, or on the first run, the
+    current month is searched. When a cache is given, messages processed by earlier
+    runs are skipped, and once a historyId has been synced only messages added since
+    then are listed (whatever month they arrived in). The historyId reached is only stored as pending until
+    `mark_processed` confirms the results were written, and not at all if any
+    message failed to download.
+    """
+    try:
+        logging.info(f"Fetching new transaction emails from {ALERT_SENDER}...")
+        messages = None
+        history_id = None
+        from_history = False
+        if cache is not None:
+            with cache:
+                cache.execute("DELETE FROM sync_state WHERE key = 'pending_history_id'")
+            # Taken before listing so messages arriving mid-run are picked up next time
+            history_id = _get_history_id(service)
+            row = cache.execute("SELECT value FROM sync_state WHERE key = 'history_id'").fetchone()
+            if row is not None:
+                try:
+                    messages = _list_new_since(service, row[0])
+                    from_history = True
+                except HttpError as history_err:
+                    # Gmail only keeps history for a limited time; fall back to a full search
+                    logging.warning(f"History sync failed, listing the whole month instead: {history_err}")
+        if messages is None:
+            messages = _list_month(service)
+        if cache is not None:
+            # Not limited to this month: history listing can return messages from before it started
+            seen = _load_seen(cache)
+            messages = [msg for msg in messages if msg['id'] not in seen]
         logging.info(f"Found {len(messages)} messages.")
         emails = []
-        for msg in messages:
-            msg_data = service.users().messages().get(userId='me', id=msg['id'], format='raw').execute()
-            msg_bytes = base64.urlsafe_b64decode(msg_data['raw'].encode('ASCII'))
-            mime_msg = message_from_bytes(msg_bytes)
-            yield mime_msg
-            emails.append(mime_msg)
+        failed_ids = []
+        # Fetch each chunk of messages in one batch round trip
+        for i in range(0, len(messages), BATCH_SIZE):
+            chunk = messages[i:i+BATCH_SIZE]
+            # History covers the whole mailbox, so check headers before downloading full bodies;
+            # the month search is already filtered by sender and subject on the server
+            if from_history:
+                try:
+                    chunk = _filter_by_subject(service, chunk)
+                except HttpError as meta_err:
+                    logging.warning(f"Subject pre-filter failed, fetching the whole chunk: {meta_err}")
+            if not chunk:
+                continue
+            fetched, failed = _fetch_chunk_with_retry(service, credentials, chunk)
+            failed_ids.extend(failed)
+
+            for msg_id, mime_msg in fetched:
+                yield msg_id, mime_msg
+                emails.append(mime_msg)
         logging.info(f"Fetched {len(emails)} emails.")
+        if failed_ids:
+            # Keep the old historyId so the next run lists the failed messages again
+            logging.warning(f"Failed to fetch {len(failed_ids)} messages; they will be retried on the next run.")
+        elif cache is not None:
+            with cache:
+                cache.execute(
+                    "INSERT OR REPLACE INTO sync_state(key, value) VALUES ('pending_history_id', ?)", (str(history_id),)
+                )
         return emails
     except Exception as e:
         logging.error(f"Error in fetch_transaction_emails: {e}")
+        if _is_auth_error(e):
+            invalidate_auth_cache()
         return []
 
 
+def _html_to_text(body):
+    """Extract the visible text from an HTML email body."""
+    try:
+        soup = BeautifulSoup(body, HTML_PARSER, parse_only=ONLY_BODY)
+        text = soup.get_text(separator=' ', strip=True)
+        if not text:
+            # Bodies without any of the strained tags (e.g. bare text) would otherwise come back empty
+            text = BeautifulSoup(body, HTML_PARSER).get_text(separator=' ', strip=True)
+        return text
+    except Exception as e:
+        logging.warning(f"BeautifulSoup failed, using raw body. Error: {e}")
+        return body.decode(errors='ignore') if isinstance(body, bytes) else str(body)
+
+
+def _parse_fetched(item):
+    """Parse a (message id, email) pair from fetch_transaction_emails, keeping the id."""
+    msg_id, email_msg = item
+    return msg_id, parse_transaction_email(email_msg)
+
+
 def parse_transaction_email(email_msg):
     """Parse transaction details from email message."""
     try:
         logging.debug("Parsing transaction email...")
-        # Try to get the HTML part if available
-        body = None
-        if email_msg.is_multipart():
-            for part in email_msg.walk():
-                content_type = part.get_content_type()
-                if content_type == 'text/html':
-                    body = part.get_payload(decode=True)
-                    break
-                elif content_type == 'text/plain' and body is None:
-                    body = part.get_payload(decode=True)
-        else:
-            body = email_msg.get_payload(decode=True)
+        subject = _decode_subject(email_msg['subject'] or '')
+        if "INR" not in subject:
+            return None
+
+        # Prefer the HTML part, falling back to plain text; stdlib stops at the first match
+        body_part = email_msg.get_body(preferencelist=('html', 'plain'))
+        body = body_part.get_content() if body_part is not None else None
         if not body:
             logging.warning("Email body is empty.")
             return None
-        # If HTML, extract text
-        try:
-            soup = BeautifulSoup(body, 'html.parser')
-            text = soup.get_text(separator=' ', strip=True)
-        except Exception as e:
-            logging.warning(f"BeautifulSoup failed, using raw body. Error: {e}")
-            text = body.decode(errors='ignore') if isinstance(body, bytes) else str(body)
-
-        # Decode subject if MIME-encoded
-        raw_subject = email_msg['subject'] or ''
-        try:
-            dh = decode_header(raw_subject)
-            subject = ''.join([
-                (part.decode(enc or 'utf-8') if isinstance(part, bytes) else part)
-                for part, enc in dh
-            ])
-        except Exception as e:
-            logging.warning(f"Failed to decode subject: {e}")
-            subject = raw_subject
-        
-        if "INR" not in subject:
-            return None
+        if body_part.get_content_subtype() == 'plain':
+            # get_content() already decoded the text; there is no markup to strip
+            text = body.strip()
+        else:
+            text = _html_to_text(body)
 
         amount = float(extract_amount(text))
         date = extract_date(text)
@@ -235,6 +540,75 @@ def authenticate_sheets():
         return None
 
 
+@functools.lru_cache(maxsize=1)
+def _get_gmail_service():
+    """Return the Gmail service and credentials, authenticating only once per process."""
+    return authenticate_gmail()
+
+
+@functools.lru_cache(maxsize=1)
+def _get_worksheet():
+    """Return the target worksheet, authenticating only once per process."""
+    return authenticate_sheets()
+
+
+def invalidate_auth_cache():
+    """Drop cached Gmail/Sheets handles so the next call re-authenticates."""
+    _get_gmail_service.cache_clear()
+    _get_worksheet.cache_clear()
+
+
+def _is_auth_error(exc):
+    """Return True if exc is an HTTP 401/403 from the Gmail or Sheets API."""
+    status = None
+    if isinstance(exc, HttpError):
+        status = getattr(exc.resp, 'status', None)
+    elif isinstance(exc, gspread.exceptions.APIError):
+        status = getattr(exc.response, 'status_code', None)
+    return status in (401, 403)
+
+
+def append_rows_with_retry(ws, rows_to_add, max_retries=5):
+    """Append rows to the worksheet in one request, retrying with backoff on quota errors."""
+    attempt = 0
+    base_delay = 1.0
+    while attempt <= max_retries:
+        try:
+            # Call the values.append endpoint directly to skip worksheet.append_rows' per-call overhead
+            ws.spreadsheet.values_append(
+                gspread.utils.absolute_range_name(ws.title, 'A1'),
+                {'valueInputOption': 'RAW', 'insertDataOption': 'INSERT_ROWS'},
+                {'values': rows_to_add}
+            )
+            logging.info(f'Appended {len(rows_to_add)} rows to sheet.')
+            return True
+        except Exception as exc:
+            # Detect quota errors (HTTP 429) from HttpError or generic exceptions
+            code = None
+            if isinstance(exc, HttpError):
+                try:
+                    code = exc.resp.status
+                except Exception:
+                    code = None
+
+            msg = str(exc)
+            if (code == 429) or ('quota' in msg.lower()) or ('write requests' in msg.lower()) or ('Rate Limit Exceeded' in msg):
+                attempt += 1
+                delay = base_delay * (2 ** (attempt - 1))
+                # add jitter
+                delay = delay * (0.8 + 0.4 * random.random())
+                logging.warning(f'Quota hit (attempt {attempt}/{max_retries}). Retrying after {delay:.1f}s...')
+                time.sleep(delay)
+                continue
+            else:
+                logging.error(f'Failed to append rows to sheet: {exc}')
+                if _is_auth_error(exc):
+                    invalidate_auth_cache()
+                return False
+    logging.error('Exceeded max retries for appending rows due to quota limits.')
+    return False
+
+
 def main():
     try:
         import argparse
@@ -242,71 +616,38 @@ def main():
         parser.add_argument('--auth-only', action='store_true', help='Run authentication flows and exit')
         args = parser.parse_args()
 
-        gmail_service = authenticate_gmail()
+        gmail_service, gmail_creds = _get_gmail_service()
         if gmail_service is None:
+            invalidate_auth_cache()
             logging.error("Gmail authentication failed. Exiting.")
             return
         if args.auth_only:
             logging.info('Auth-only mode: Gmail auth succeeded. Now authenticate Sheets if desired.')
-            _ = authenticate_sheets()
+            _ = _get_worksheet()
             logging.info('Auth-only flow complete. Exiting.')
             return
 
-        transactions = []
-        for e in fetch_transaction_emails(gmail_service):
-            transactions.append(parse_transaction_email(e))
-        emails = fetch_transaction_emails(gmail_service)
-        transactions = [parse_transaction_email(e) for e in emails]
-        transactions = [t for t in transactions if t]
-        worksheet = authenticate_sheets()
+        cache = open_cache()
+
+        # Parse in worker processes so parsing uses every core and overlaps with fetching the next batch
+        with ProcessPoolExecutor(max_workers=PARSE_WORKERS) as pool:
+            emails = fetch_transaction_emails(gmail_service, gmail_creds, cache)
+            results = list(pool.map(_parse_fetched, emails, chunksize=PARSE_CHUNK_SIZE))
+        fetched_ids = [msg_id for msg_id, _ in results]
+        transactions = [t for _, t in results if t]
+        worksheet = _get_worksheet()
         if worksheet is None:
+            invalidate_auth_cache()
             logging.error('Google Sheets authentication failed. Skipping sheet writes.')
             return
 
-        # Prepare rows and write in batches to avoid per-row write quota limits
+        # Write every row in a single values.append call to avoid per-row write quota limits
         rows = [[t['date'], t['merchant'], t['amount'], t['type']] for t in transactions]
-
-        def append_rows_with_retry(ws, rows_to_add, max_retries=5):
-            attempt = 0
-            base_delay = 1.0
-            while attempt <= max_retries:
-                try:
-                    # gspread's worksheet.append_rows reduces number of write requests
-                    ws.append_rows(rows_to_add, value_input_option='RAW')
-                    logging.info(f'Appended {len(rows_to_add)} rows to sheet.')
-                    return True
-                except Exception as exc:
-                    # Detect quota errors (HTTP 429) from HttpError or generic exceptions
-                    code = None
-                    if isinstance(exc, HttpError):
-                        try:
-                            code = exc.resp.status
-                        except Exception:
-                            code = None
-
-                    msg = str(exc)
-                    if (code == 429) or ('quota' in msg.lower()) or ('write requests' in msg.lower()) or ('Rate Limit Exceeded' in msg):
-                        attempt += 1
-                        delay = base_delay * (2 ** (attempt - 1))
-                        # add jitter
-                        delay = delay * (0.8 + 0.4 * (os.urandom(1)[0] / 255.0))
-                        logging.warning(f'Quota hit (attempt {attempt}/{max_retries}). Retrying after {delay:.1f}s...')
-                        time.sleep(delay)
-                        continue
-                    else:
-                        logging.error(f'Failed to append rows to sheet: {exc}')
-                        return False
-            logging.error('Exceeded max retries for appending rows due to quota limits.')
-            return False
-
-        # chunk rows into groups (gspread may handle many rows, but keep sizes moderate)
-        chunk_size = 100
-        for i in range(0, len(rows), chunk_size):
-            chunk = rows[i:i+chunk_size]
-            success = append_rows_with_retry(worksheet, chunk)
-            if not success:
-                logging.error('Stopping further writes due to repeated failures.')
-                break
+        if rows and not append_rows_with_retry(worksheet, rows):
+            logging.error('Failed to write transactions to the sheet.')
+            return
+        # Only remember messages once their rows are safely in the sheet
+        mark_processed(cache, fetched_ids)
     except Exception as e:
         logging.error(f"Error in main: {e}")
 
@@ -1,42 +1,48 @@
 import re
 
+# Patterns are compiled once at import time since they run for every email
+_AMOUNT_RE = re.compile(r'INR\s*([0-9,.]+)')
+_DATE_RE = re.compile(r'(\d{2}-\d{2}-\d{2,4})')
+_TXN_INFO_RE = re.compile(r'Transaction Info:\s*([\w\s\-/]+)')
+_NEFT_RE = re.compile(r'(NEFT|IMPS|RTGS|CMS)[^\s/]*\/([A-Z0-9 ]+)')
+_UPI_RE = re.compile(r'(UPI/[\w/]+/[A-Z0-9 ]+)')
+_MERCHANT_RE = re.compile(r'Merchant Name:\s*([\w .,&-]+)')
+_SENTINEL_RE = re.compile(r' (?:If this transaction|Feel free to connect)')
+
+def _trim(s):
+    # Cut at the first boilerplate sentence following the merchant, if any
+    m = _SENTINEL_RE.search(s)
+    return s[:m.start()].strip() if m else s.strip()
+
 def extract_amount(text):
-    match = re.search(r'INR\s*([0-9,.]+)', text)
+    match = _AMOUNT_RE.search(text)
     return match.group(1) if match else ''
 
 def extract_date(text):
-    match = re.search(r'(\d{2}-\d{2}-\d{2,4})', text)
+    match = _DATE_RE.search(text)
     return match.group(1) if match else ''
 
 def extract_merchant(text):
     # Transaction Info
-    m = re.search(r'Transaction Info:\s*([\w\s\-/]+)', text)
+    m = _TXN_INFO_RE.search(text)
     if m:
         merchant_candidate = m.group(1).strip()
         if merchant_candidate.startswith('UPI/'):
             # Extract up to the first occurrence of ' If this transaction' or ' Feel free to connect' or end of string
-            end_idx = max(merchant_candidate.find(' If this transaction'), merchant_candidate.find(' Feel free to connect'))
-            if end_idx != -1:
-                return merchant_candidate[:end_idx].strip()
-            # Otherwise, return the whole string
-            return merchant_candidate
+            return _trim(merchant_candidate)
         return merchant_candidate
     # NEFT/IMPS/RTGS/CMS fallback: extract after last slash if present
-    m4 = re.search(r'(NEFT|IMPS|RTGS|CMS)[^\s/]*\/([A-Z0-9 ]+)', text)
+    m4 = _NEFT_RE.search(text)
     if m4:
         merchant_full = m4.group(2).strip()
         merchant_words = merchant_full.split()
         return ' '.join(merchant_words[:2]) if len(merchant_words) >= 2 else merchant_full
     # UPI fallback
-    m2 = re.search(r'(UPI/[\w/]+/[A-Z0-9 ]+)', text)
+    m2 = _UPI_RE.search(text)
     if m2:
-        merchant_candidate = m2.group(1).strip()
-        end_idx = max(merchant_candidate.find(' If this transaction'), merchant_candidate.find(' Feel free to connect'))
-        if end_idx != -1:
-            return merchant_candidate[:end_idx].strip()
-        return merchant_candidate
+        return _trim(m2.group(1))
     # Credit card spend: Merchant Name
-    m3 = re.search(r'Merchant Name:\s*([\w .,&-]+)', text)
+    m3 = _MERCHANT_RE.search(text)
     if m3:
         merchant_full = m3.group(1).strip()
         merchant_words = merchant_full.split()
@@ -44,10 +50,13 @@ def extract_merchant(text):
     return ''
 
 def extract_transaction_type(text, subject):
-    if re.search(r'\b(debited)\b', text, re.IGNORECASE) or re.search(r'\b(debited)\b', subject, re.IGNORECASE):
+    # Plain substring checks are cheaper than regex for these short keywords
+    t = text.casefold()
+    s = subject.casefold()
+    if 'debited' in t or 'debited' in s:
         return 'debit'
-    elif re.search(r'\b(credited)\b', text, re.IGNORECASE) or re.search(r'\b(credited)\b', subject, re.IGNORECASE):
+    elif 'credited' in t or 'credited' in s:
         return 'credit'
-    elif re.search(r'\bspent\b', text, re.IGNORECASE) or re.search(r'\bspent\b', subject, re.IGNORECASE):
+    elif 'spent' in t or 'spent' in s:
         return 'debit'
     return ''
\ No newline at end of file